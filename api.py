@@ -1,125 +1,634 @@
+import asyncio
+import hashlib
+import json
+import multiprocessing
 import os
-import re
-import shutil
-import urllib.request
+import sqlite3
+import tempfile
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from itertools import chain
 from pathlib import Path
-from tempfile import NamedTemporaryFile
-from litellm import completion
-import fitz
+from typing import List
+
+# Thread pools size themselves when the native libraries load, so pin them to the
+# CPUs this process may actually use (containers often expose fewer than the host).
+CPU_COUNT = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count() or 1
+os.environ.setdefault('OMP_NUM_THREADS', str(CPU_COUNT))
+os.environ.setdefault('TF_NUM_INTRAOP_THREADS', str(CPU_COUNT))
+os.environ.setdefault('TF_NUM_INTEROP_THREADS', '1')
+
+import litellm
+import faiss
+import httpx
 import numpy as np
-import openai
+import tensorflow as tf
 import tensorflow_hub as hub
 from fastapi import UploadFile
 from lcserve import serving
-from sklearn.neighbors import NearestNeighbors
 
+from pdf_text import extract_pages, open_pdf, read_pages
+
+
+CacheInfo = namedtuple('CacheInfo', ['hits', 'misses', 'maxsize', 'currsize'])
+
+encoder = None
+page_pool = None
+_page_pool_lock = threading.Lock()
+recommenders = OrderedDict()
+url_recommenders = OrderedDict()
+_recommenders_lock = threading.Lock()
+_encoder_lock = threading.Lock()
+
+USE_MODEL_URL = 'https://tfhub.dev/google/universal-sentence-encoder/4'
+MINILM_MODEL = 'sentence-transformers/all-MiniLM-L6-v2'
+
+QA_CACHE_SIZE = 500
+QA_CACHE_TTL = 60 * 60
+QA_CACHE_THRESHOLD = 0.95
+QUERY_CACHE_SIZE = 1024
+RECOMMENDER_CACHE_SIZE = 8
+URL_CACHE_TTL = 10 * 60
+MAX_PDF_BYTES = 100 * 1024 * 1024
+CORPUS_CACHE_DIR = Path('cache')
+CORPUS_CACHE_MAX_ENTRIES = 256
+EMBEDDING_STORE_PATH = Path.home() / '.cache' / 'pdfgpt' / 'use_embs.sqlite'
+EMBEDDING_STORE_MAX_ENTRIES = 100_000
+EMBEDDING_STORE_TIMEOUT = 5
+PCA_COMPONENTS = 128
+HNSW_MIN_CHUNKS = 10_000
+PAGE_WORKERS = CPU_COUNT
+PARALLEL_PAGE_THRESHOLD = 64
+
+_PROMPT_HEADER = 'search results:\n\n'
+_PROMPT_INSTRUCTIONS = (
+    "Instructions: Compose a comprehensive reply to the query using the search results given. "
+    "Cite each reference using [ Page Number] notation (every result has this number at the beginning). "
+    "Citation should be done at the end of each sentence. If the search results mention multiple subjects "
+    "with the same name, create separate answers for each. Only include information found in the results and "
+    "don't add any additional information. Make sure the answer is correct and don't output false content. "
+    "If the text does not relate to the query, simply state 'Text Not Found in PDF'. Ignore outlier "
+    "search results which has nothing to do with the question. Only answer what is asked. The "
+    "answer should be short and concise. Answer step-by-step. \n\n"
+)
+
+litellm.aclient_session = httpx.AsyncClient(
+    http2=True,
+    timeout=30,
+    limits=httpx.Limits(max_keepalive_connections=4),
+)
+tf.config.threading.set_intra_op_parallelism_threads(int(os.environ['TF_NUM_INTRAOP_THREADS']))
+tf.config.threading.set_inter_op_parallelism_threads(int(os.environ['TF_NUM_INTEROP_THREADS']))
+
+_download_client = httpx.AsyncClient(
+    timeout=60,
+    follow_redirects=True,
+    limits=httpx.Limits(max_connections=8, max_keepalive_connections=4),
+)
+
+
+async def download_pdf(url):
+    data = bytearray()
+    async with _download_client.stream('GET', url) as r:
+        r.raise_for_status()
+        if int(r.headers.get('Content-Length', 0)) > MAX_PDF_BYTES:
+            raise ValueError(f'PDF at {url} is larger than {MAX_PDF_BYTES} bytes')
+        async for chunk in r.aiter_bytes(chunk_size=1 << 20):
+            data += chunk
+            # Content-Length can be missing or wrong, so also bound what is buffered.
+            if len(data) > MAX_PDF_BYTES:
+                raise ValueError(f'PDF at {url} is larger than {MAX_PDF_BYTES} bytes')
+    # Everything downstream accepts a bytearray; converting would copy the whole file.
+    return data
+
+
+def pdf_to_text(source, start_page=1, end_page=None):
+    start = start_page - 1
+    with open_pdf(source) as doc:
+        if end_page is None:
+            end_page = doc.page_count
+        if end_page - start < PARALLEL_PAGE_THRESHOLD:
+            return read_pages(doc, start, end_page)
+
+    # MuPDF holds the GIL and documents can't be shared, so each worker opens its own.
+    # In-memory PDFs are spilled to disk once so workers get a path, not a pickled copy.
+    temp_path = None
+    if isinstance(source, (bytes, bytearray)):
+        with tempfile.NamedTemporaryFile(suffix='.pdf', delete=False) as f:
+            f.write(source)
+        source = temp_path = f.name
+    try:
+        pool = get_page_pool()
+        step = -(-(end_page - start) // PAGE_WORKERS)
+        starts = range(start, end_page, step)
+        stops = [min(i + step, end_page) for i in starts]
+        try:
+            parts = pool.map(extract_pages, [source] * len(starts), starts, stops)
+            return list(chain.from_iterable(parts))
+        except BrokenProcessPool:
+            # A worker died (MuPDF crash on a malformed file, OOM kill): replace the
+            # pool for later requests and finish this one in-process.
+            reset_page_pool(pool)
+            return extract_pages(source, start, end_page)
+    finally:
+        if temp_path is not None:
+            os.unlink(temp_path)
+
+
+def get_page_pool():
+    global page_pool
+    with _page_pool_lock:
+        if page_pool is None:
+            # Forking a process that already runs TF and HTTP client threads is unsafe.
+            methods = multiprocessing.get_all_start_methods()
+            context = multiprocessing.get_context(
+                'forkserver' if 'forkserver' in methods else 'spawn'
+            )
+            page_pool = ProcessPoolExecutor(max_workers=PAGE_WORKERS, mp_context=context)
+        return page_pool
+
+
+def reset_page_pool(pool):
+    global page_pool
+    with _page_pool_lock:
+        # Another request may already have replaced the broken pool.
+        if page_pool is pool:
+            page_pool = None
+    pool.shutdown(wait=False)
 
-recommender = None
 
+def text_to_chunks(texts, word_length=150, start_page=1):
+    text_toks = [t.split(' ') for t in texts]
+    words = list(chain.from_iterable(text_toks))
+    page_ends = np.cumsum([len(t) for t in text_toks])
+
+    # Trailing partial chunks carry into the next page, so chunking the flat word stream is
+    # equivalent; each chunk is labelled with the page holding its last word.
+    starts = np.arange(0, len(words), word_length)
+    last_words = np.minimum(starts + word_length, len(words)) - 1
+    pages = np.searchsorted(page_ends, last_words, side='right') + start_page
+    return [
+        '[Page no. %d] "%s"' % (page, ' '.join(words[i : i + word_length]).strip())
+        for i, page in zip(starts.tolist(), pages.tolist())
+    ]
+
+
+def normalize(embeddings):
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    return embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)
+
+
+class TFLiteEncoder:
+    def __init__(self, model_path):
+        self.interpreter = tf.lite.Interpreter(model_path=model_path)
+        self.input_index = self.interpreter.get_input_details()[0]['index']
+        self.output_index = self.interpreter.get_output_details()[0]['index']
+        self.lock = threading.Lock()
+
+    def __call__(self, texts):
+        with self.lock:
+            self.interpreter.resize_tensor_input(self.input_index, [len(texts)])
+            self.interpreter.allocate_tensors()
+            self.interpreter.set_tensor(self.input_index, np.array(texts, dtype=object))
+            self.interpreter.invoke()
+            return self.interpreter.get_tensor(self.output_index)
+
+
+class OnnxEncoder:
+    def __init__(self, model_path):
+        import onnxruntime as ort
+        import onnxruntime_extensions
+
+        options = ort.SessionOptions()
+        # USE's tokenizer exports as ai.onnx.contrib string ops.
+        options.register_custom_ops_library(onnxruntime_extensions.get_library_path())
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        options.intra_op_num_threads = CPU_COUNT
+        self.session = ort.InferenceSession(
+            model_path, sess_options=options, providers=['CPUExecutionProvider']
+        )
+        self.input_name = self.session.get_inputs()[0].name
 
-def download_pdf(url, output_path):
-    urllib.request.urlretrieve(url, output_path)
+    def __call__(self, texts):
+        return self.session.run(None, {self.input_name: np.array(texts, dtype=object)})[0]
 
 
-def preprocess(text):
-    text = text.replace('\n', ' ')
-    text = re.sub('\s+', ' ', text)
-    return text
+class MiniLMEncoder:
+    def __init__(self, model_dir):
+        from optimum.onnxruntime import ORTModelForFeatureExtraction
+        from transformers import AutoTokenizer
 
+        self.tokenizer = AutoTokenizer.from_pretrained(model_dir)
+        self.model = ORTModelForFeatureExtraction.from_pretrained(
+            model_dir, file_name='model_quantized.onnx', provider='CPUExecutionProvider'
+        )
 
-def pdf_to_text(path, start_page=1, end_page=None):
-    doc = fitz.open(path)
-    total_pages = doc.page_count
+    def __call__(self, texts):
+        inputs = self.tokenizer(
+            list(texts), padding=True, truncation=True, return_tensors='np'
+        )
+        hidden = self.model(**inputs).last_hidden_state
+        mask = inputs['attention_mask'][..., None]
+        return (hidden * mask).sum(axis=1) / np.maximum(mask.sum(axis=1), 1)
+
+
+def quantize_minilm(output_dir):
+    from optimum.onnxruntime import ORTModelForFeatureExtraction, ORTQuantizer
+    from optimum.onnxruntime.configuration import AutoQuantizationConfig
+    from transformers import AutoTokenizer
+
+    model = ORTModelForFeatureExtraction.from_pretrained(MINILM_MODEL, export=True)
+    quantizer = ORTQuantizer.from_pretrained(model)
+    qconfig = AutoQuantizationConfig.avx512_vnni(is_static=False, per_channel=False)
+    quantizer.quantize(save_dir=output_dir, quantization_config=qconfig)
+    AutoTokenizer.from_pretrained(MINILM_MODEL).save_pretrained(output_dir)
+
+
+def convert_use_to_tflite(output_path):
+    converter = tf.lite.TFLiteConverter.from_saved_model(hub.resolve(USE_MODEL_URL))
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    converter.target_spec.supported_ops = [
+        tf.lite.OpsSet.TFLITE_BUILTINS,
+        tf.lite.OpsSet.SELECT_TF_OPS,
+    ]
+    Path(output_path).write_bytes(converter.convert())
+
+
+def load_encoder():
+    minilm_dir = os.environ.get('MINILM_MODEL_DIR')
+    if minilm_dir:
+        return 'minilm-int8', MiniLMEncoder(minilm_dir)
+    onnx_path = os.environ.get('USE_ONNX_MODEL')
+    if onnx_path:
+        return 'use-onnx', OnnxEncoder(onnx_path)
+    tflite_path = os.environ.get('USE_TFLITE_MODEL')
+    if tflite_path:
+        return 'use-tflite', TFLiteEncoder(tflite_path)
+
+    model = hub.load(USE_MODEL_URL)
+    embed = tf.function(
+        lambda texts: model(texts),
+        input_signature=[tf.TensorSpec(shape=[None], dtype=tf.string)],
+    )
+    return 'use', lambda texts: embed(tf.constant(texts)).numpy()
+
+
+class EmbeddingBatcher:
+    def __init__(self, encode, max_batch=32, max_wait=0.01):
+        self.encode = encode
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self._loop = None
+        self._queue = None
+
+    async def embed(self, text):
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop = loop
+            self._queue = asyncio.Queue()
+            loop.create_task(self._run(self._queue))
+
+        future = loop.create_future()
+        await self._queue.put((text, future))
+        return await future
+
+    async def _run(self, queue):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            texts = [text for text, _ in batch]
+            try:
+                emb = await loop.run_in_executor(None, self.encode, texts)
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
 
-    if end_page is None:
-        end_page = total_pages
+            for i, (_, future) in enumerate(batch):
+                if not future.done():
+                    future.set_result(emb[i : i + 1])
 
-    text_list = []
 
-    for i in range(start_page - 1, end_page):
-        text = doc.load_page(i).get_text("text")
-        text = preprocess(text)
-        text_list.append(text)
+def open_embedding_store():
+    EMBEDDING_STORE_PATH.parent.mkdir(parents=True, exist_ok=True)
+    conn = sqlite3.connect(str(EMBEDDING_STORE_PATH), timeout=EMBEDDING_STORE_TIMEOUT)
+    # WAL lets other API processes keep reading while one of them writes.
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute(
+        'CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, emb BLOB, used REAL)'
+    )
+    conn.execute('CREATE INDEX IF NOT EXISTS embeddings_used ON embeddings (used)')
+    return conn
 
-    doc.close()
-    return text_list
 
+def read_embedding_store(keys, chunk_size=500):
+    # The store is only a cache: if it is unreadable, everything is a miss. Reads never
+    # take the write lock; hits get their timestamps refreshed by write_embedding_store.
+    found = {}
+    try:
+        conn = open_embedding_store()
+        try:
+            for i in range(0, len(keys), chunk_size):
+                part = keys[i : (i + chunk_size)]
+                marks = ','.join('?' * len(part))
+                rows = conn.execute(
+                    f'SELECT key, emb FROM embeddings WHERE key IN ({marks})', part
+                ).fetchall()
+                found.update(rows)
+        finally:
+            conn.close()
+    except sqlite3.Error:
+        pass
+    return [
+        np.frombuffer(found[key], dtype=np.float32) if key in found else None
+        for key in keys
+    ]
+
+
+def write_embedding_store(embeddings, used_keys=()):
+    # One short write transaction per fit: insert new rows, mark hits as recently
+    # used, and trim the oldest rows once the store is over its cap.
+    now = time.time()
+    try:
+        conn = open_embedding_store()
+        try:
+            with conn:
+                conn.executemany(
+                    'INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?)',
+                    ((key, emb.tobytes(), now) for key, emb in embeddings.items()),
+                )
+                conn.executemany(
+                    'UPDATE embeddings SET used = ? WHERE key = ?',
+                    ((now, key) for key in used_keys),
+                )
+                (count,) = conn.execute('SELECT COUNT(*) FROM embeddings').fetchone()
+                if count > EMBEDDING_STORE_MAX_ENTRIES:
+                    conn.execute(
+                        'DELETE FROM embeddings WHERE key IN '
+                        '(SELECT key FROM embeddings ORDER BY used LIMIT ?)',
+                        (count - EMBEDDING_STORE_MAX_ENTRIES,),
+                    )
+        finally:
+            conn.close()
+    except sqlite3.Error:
+        pass
+
+
+class SentenceEncoder:
+    def __init__(self):
+        self.name, self.use = load_encoder()
+        self.batcher = EmbeddingBatcher(lambda texts: normalize(self.use(texts)))
+        self.query_cache = OrderedDict()
+        self.query_hits = 0
+        self.query_misses = 0
+        self.lock = threading.Lock()
+
+    def embed(self, text):
+        inp_emb = self.query_cache.get(text)
+        hit = inp_emb is not None
+        if not hit:
+            inp_emb = normalize(self.use([text]))
+        self._remember_query(text, inp_emb, hit)
+        return inp_emb
+
+    async def aembed(self, text):
+        inp_emb = self.query_cache.get(text)
+        hit = inp_emb is not None
+        if not hit:
+            inp_emb = await self.batcher.embed(text)
+        self._remember_query(text, inp_emb, hit)
+        return inp_emb
+
+    def _remember_query(self, text, inp_emb, hit):
+        with self.lock:
+            if hit:
+                self.query_hits += 1
+            else:
+                self.query_misses += 1
+            self.query_cache[text] = inp_emb
+            self.query_cache.move_to_end(text)
+            if len(self.query_cache) > QUERY_CACHE_SIZE:
+                self.query_cache.popitem(last=False)
+
+    def cache_info(self):
+        return CacheInfo(
+            self.query_hits, self.query_misses, QUERY_CACHE_SIZE, len(self.query_cache)
+        )
 
-def text_to_chunks(texts, word_length=150, start_page=1):
-    text_toks = [t.split(' ') for t in texts]
-    chunks = []
-
-    for idx, words in enumerate(text_toks):
-        for i in range(0, len(words), word_length):
-            chunk = words[i : i + word_length]
-            if (
-                (i + word_length) > len(words)
-                and (len(chunk) < word_length)
-                and (len(text_toks) != (idx + 1))
-            ):
-                text_toks[idx + 1] = chunk + text_toks[idx + 1]
-                continue
-            chunk = ' '.join(chunk).strip()
-            chunk = f'[Page no. {idx+start_page}]' + ' ' + '"' + chunk + '"'
-            chunks.append(chunk)
-    return chunks
+    def get_text_embedding(self, texts, batch=128):
+        keys = [f'{self.name}:{hashlib.sha256(t.encode()).hexdigest()}' for t in texts]
+        cached = read_embedding_store(keys)
+
+        out = None
+        hits = [i for i, emb in enumerate(cached) if emb is not None]
+        if hits:
+            out = np.empty((len(texts), len(cached[hits[0]])), dtype=np.float32)
+            for i in hits:
+                out[i] = cached[i]
+
+        # Chunks all have the same word count, so order misses by characters, which
+        # tracks token count and keeps padded batches of similar length.
+        misses = [i for i, emb in enumerate(cached) if emb is None]
+        misses.sort(key=lambda i: len(texts[i]))
+        computed = {}
+        for i in range(0, len(misses), batch):
+            idx_batch = misses[i : (i + batch)]
+            emb_batch = np.asarray(self.use([texts[j] for j in idx_batch]), dtype=np.float32)
+            if out is None:
+                out = np.empty((len(texts), emb_batch.shape[1]), dtype=np.float32)
+            out[idx_batch] = emb_batch
+            computed.update(zip((keys[j] for j in idx_batch), emb_batch))
+
+        if computed or hits:
+            write_embedding_store(computed, used_keys=[keys[i] for i in hits])
+        return out
 
 
 class SemanticSearch:
-    def __init__(self):
-        self.use = hub.load('https://tfhub.dev/google/universal-sentence-encoder/4')
+    def __init__(self, encoder, key=None):
+        self.encoder = encoder
+        self.key = key
+        self.qa_cache = []
         self.fitted = False
 
-    def fit(self, data, batch=1000, n_neighbors=5):
-        self.data = data
-        self.embeddings = self.get_text_embedding(data, batch=batch)
-        n_neighbors = min(n_neighbors, len(self.embeddings))
-        self.nn = NearestNeighbors(n_neighbors=n_neighbors)
-        self.nn.fit(self.embeddings)
+    def fit(self, data, batch=128, n_neighbors=5):
+        embeddings = normalize(self.encoder.get_text_embedding(data, batch=batch))
+        self.fit_embeddings(data, embeddings, n_neighbors=n_neighbors)
+
+    def fit_embeddings(self, data, embeddings, n_neighbors=5):
+        embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+        # PCA changes vector lengths, so re-normalise to keep inner product == cosine.
+        transform = f'PCA{PCA_COMPONENTS},L2norm,' if len(embeddings) > PCA_COMPONENTS else ''
+        storage = 'HNSW32_SQ8' if len(embeddings) > HNSW_MIN_CHUNKS else 'SQ8'
+        index = faiss.index_factory(
+            embeddings.shape[1], transform + storage, faiss.METRIC_INNER_PRODUCT
+        )
+        index.train(embeddings)
+        index.add(embeddings)
+        self.fit_index(data, index, n_neighbors=n_neighbors)
+
+    def fit_index(self, data, index, n_neighbors=5):
+        self.data = np.asarray(data, dtype=object)
+        self.qa_cache = []
+        self.k = min(n_neighbors, index.ntotal)
+        if index.ntotal > HNSW_MIN_CHUNKS:
+            faiss.ParameterSpace().set_index_parameter(index, 'efSearch', 64)
+        self.index = index
         self.fitted = True
 
     def __call__(self, text, return_data=True):
-        inp_emb = self.use([text])
-        neighbors = self.nn.kneighbors(inp_emb, return_distance=False)[0]
+        return self.search(self.encoder.embed(text), return_data=return_data)
+
+    def search(self, inp_emb, return_data=True):
+        q = np.ascontiguousarray(inp_emb, dtype=np.float32)
+        _, labels = self.index.search(q, self.k)
+        neighbors = labels[0][labels[0] >= 0]
 
         if return_data:
-            return [self.data[i] for i in neighbors]
+            return self.data[neighbors].tolist()
         else:
             return neighbors
 
-    def get_text_embedding(self, texts, batch=1000):
-        embeddings = []
-        for i in range(0, len(texts), batch):
-            text_batch = texts[i : (i + batch)]
-            emb_batch = self.use(text_batch)
-            embeddings.append(emb_batch)
-        embeddings = np.vstack(embeddings)
-        return embeddings
+    def cached_answer(self, q_emb):
+        now = time.monotonic()
+        self.qa_cache = [e for e in self.qa_cache if now - e[2] < QA_CACHE_TTL]
+        if not self.qa_cache:
+            return None
 
+        sims = np.vstack([e for e, _, _ in self.qa_cache]) @ q_emb[0]
+        best = int(np.argmax(sims))
+        if sims[best] < QA_CACHE_THRESHOLD:
+            return None
 
-def load_recommender(path, start_page=1):
-    global recommender
-    if recommender is None:
-        recommender = SemanticSearch()
+        entry = self.qa_cache.pop(best)
+        self.qa_cache.append(entry)
+        return entry[1]
+
+    def cache_answer(self, q_emb, answer):
+        self.qa_cache.append((q_emb[0], answer, time.monotonic()))
+        if len(self.qa_cache) > QA_CACHE_SIZE:
+            self.qa_cache.pop(0)
 
-    texts = pdf_to_text(path, start_page=start_page)
-    chunks = text_to_chunks(texts, start_page=start_page)
-    recommender.fit(chunks)
-    return 'Corpus Loaded.'
 
+def get_encoder():
+    global encoder
+    with _encoder_lock:
+        if encoder is None:
+            encoder = SentenceEncoder()
+        return encoder
 
-def generate_text(openAI_key, prompt, engine="text-davinci-003"):
-    # openai.api_key = openAI_key
+
+def warm_up_encoder():
+    # The first inference after loading USE is several seconds slower than the rest.
+    get_encoder().use(['warmup'])
+
+
+def start_warm_up():
+    threading.Thread(target=warm_up_encoder, daemon=True).start()
+
+
+# Opt-in so that importing api for one-off scripts doesn't download the encoder.
+if os.environ.get('PDFGPT_WARMUP') == '1':
+    start_warm_up()
+
+
+def write_atomically(path, write):
+    # Concurrent loaders of the same PDF must never see a half-written file.
+    fd, temp_path = tempfile.mkstemp(dir=path.parent, suffix='.tmp')
+    os.close(fd)
+    try:
+        write(temp_path)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+
+
+def prune_corpus_cache():
+    # Hits touch the JSON file, so its mtime orders corpora by last use.
+    entries = []
+    for path in CORPUS_CACHE_DIR.glob('*.json'):
+        try:
+            entries.append((path.stat().st_mtime, path))
+        except FileNotFoundError:
+            pass
+    entries.sort(reverse=True)
+    for _, chunks_path in entries[CORPUS_CACHE_MAX_ENTRIES:]:
+        # JSON first, so a concurrent loader never sees chunks without their index.
+        chunks_path.unlink(missing_ok=True)
+        chunks_path.with_suffix('.faiss').unlink(missing_ok=True)
+
+
+def load_recommender(source, start_page=1):
+    if not isinstance(source, (bytes, bytearray)):
+        source = Path(source).read_bytes()
+    digest = hashlib.sha256(source).hexdigest()
+    key = f'{get_encoder().name}-{digest}-{start_page}'
+
+    with _recommenders_lock:
+        recommender = recommenders.get(key)
+        if recommender is not None:
+            recommenders.move_to_end(key)
+            return recommender
+
+    recommender = SemanticSearch(get_encoder(), key=key)
+    index_path = CORPUS_CACHE_DIR / f'{key}.faiss'
+    chunks_path = index_path.with_suffix('.json')
+
+    chunks = None
+    # The JSON is written last, so both existing means the index is complete too.
+    if index_path.exists() and chunks_path.exists():
+        try:
+            chunks = json.loads(chunks_path.read_text())
+            recommender.fit_index(chunks, faiss.read_index(str(index_path)))
+            os.utime(chunks_path)
+        except (OSError, RuntimeError):
+            # Pruned by another loader in the meantime (faiss raises RuntimeError).
+            chunks = None
+    if chunks is None:
+        texts = pdf_to_text(source, start_page=start_page)
+        chunks = text_to_chunks(texts, start_page=start_page)
+        recommender.fit(chunks)
+
+        CORPUS_CACHE_DIR.mkdir(exist_ok=True)
+        write_atomically(index_path, lambda path: faiss.write_index(recommender.index, path))
+        write_atomically(chunks_path, lambda path: Path(path).write_text(json.dumps(chunks)))
+        prune_corpus_cache()
+
+    with _recommenders_lock:
+        recommenders[key] = recommender
+        if len(recommenders) > RECOMMENDER_CACHE_SIZE:
+            recommenders.popitem(last=False)
+    return recommender
+
+
+async def generate_text(openAI_key, prompt, engine="text-davinci-003"):
     try:
         messages=[{ "content": prompt,"role": "user"}]
-        completions = completion(
+        completions = await litellm.acompletion(
             model=engine,
             messages=messages,
             max_tokens=512,
             n=1,
             stop=None,
             temperature=0.7,
-            api_key=openAI_key
+            api_key=openAI_key,
+            timeout=30,
+            num_retries=2,
         )
         message = completions['choices'][0]['message']['content']
     except Exception as e:
@@ -127,29 +636,27 @@ def generate_text(openAI_key, prompt, engine="text-davinci-003"):
     return message 
 
 
-def generate_answer(question, openAI_key):
-    topn_chunks = recommender(question)
-    prompt = ""
-    prompt += 'search results:\n\n'
-    for c in topn_chunks:
-        prompt += c + '\n\n'
-
-    prompt += (
-        "Instructions: Compose a comprehensive reply to the query using the search results given. "
-        "Cite each reference using [ Page Number] notation (every result has this number at the beginning). "
-        "Citation should be done at the end of each sentence. If the search results mention multiple subjects "
-        "with the same name, create separate answers for each. Only include information found in the results and "
-        "don't add any additional information. Make sure the answer is correct and don't output false content. "
-        "If the text does not relate to the query, simply state 'Text Not Found in PDF'. Ignore outlier "
-        "search results which has nothing to do with the question. Only answer what is asked. The "
-        "answer should be short and concise. Answer step-by-step. \n\nQuery: {question}\nAnswer: "
-    )
+async def generate_answer(recommender, question, openAI_key):
+    q_emb = await recommender.encoder.aembed(question)
+    answer = recommender.cached_answer(q_emb)
+    if answer is not None:
+        return answer
 
-    prompt += f"Query: {question}\nAnswer:"
-    answer = generate_text(openAI_key, prompt, "text-davinci-003")
+    topn_chunks = recommender.search(q_emb)
+    body = '\n\n'.join(topn_chunks)
+    prompt = f"{_PROMPT_HEADER}{body}\n\n{_PROMPT_INSTRUCTIONS}Query: {question}\nAnswer:"
+    answer = await generate_text(openAI_key, prompt, "text-davinci-003")
+    if not answer.startswith('API Error:'):
+        recommender.cache_answer(q_emb, answer)
     return answer
 
 
+async def generate_answers(recommender, questions, openAI_key):
+    return await asyncio.gather(
+        *(generate_answer(recommender, q, openAI_key) for q in questions)
+    )
+
+
 def load_openai_key() -> str:
     key = os.environ.get("OPENAI_API_KEY")
     if key is None:
@@ -159,21 +666,45 @@ def load_openai_key() -> str:
     return key
 
 
+async def load_url_recommender(url):
+    # Only the corpus key is kept per URL; the recommender itself lives in (and is
+    # evicted from) recommenders, so this map never pins indexes in memory.
+    recommender = None
+    key, loaded_at = url_recommenders.get(url, (None, 0))
+    if key is not None and time.monotonic() - loaded_at < URL_CACHE_TTL:
+        with _recommenders_lock:
+            recommender = recommenders.get(key)
+            if recommender is not None:
+                recommenders.move_to_end(key)
+    if recommender is None:
+        loop = asyncio.get_running_loop()
+        data = await download_pdf(url)
+        recommender = await loop.run_in_executor(None, load_recommender, data)
+        url_recommenders[url] = (recommender.key, time.monotonic())
+        if len(url_recommenders) > RECOMMENDER_CACHE_SIZE:
+            url_recommenders.popitem(last=False)
+    url_recommenders.move_to_end(url)
+    return recommender
+
+
 @serving
-def ask_url(url: str, question: str):
-    download_pdf(url, 'corpus.pdf')
-    load_recommender('corpus.pdf')
+async def ask_url(url: str, question: str):
+    recommender = await load_url_recommender(url)
     openAI_key = load_openai_key()
-    return generate_answer(question, openAI_key)
+    return await generate_answer(recommender, question, openAI_key)
 
 
 @serving
-async def ask_file(file: UploadFile, question: str) -> str:
-    suffix = Path(file.filename).suffix
-    with NamedTemporaryFile(delete=False, suffix=suffix) as tmp:
-        shutil.copyfileobj(file.file, tmp)
-        tmp_path = Path(tmp.name)
+async def ask_url_batch(url: str, questions: List[str]) -> List[str]:
+    recommender = await load_url_recommender(url)
+    openAI_key = load_openai_key()
+    return await generate_answers(recommender, questions, openAI_key)
+
 
-    load_recommender(str(tmp_path))
+@serving
+async def ask_file(file: UploadFile, question: str) -> str:
+    data = await file.read()
+    loop = asyncio.get_running_loop()
+    recommender = await loop.run_in_executor(None, load_recommender, data)
     openAI_key = load_openai_key()
-    return generate_answer(question, openAI_key)
+    return await generate_answer(recommender, question, openAI_key)
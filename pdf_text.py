@@ -0,0 +1,20 @@
+import fitz
+
+
+def preprocess(text):
+    return ' '.join(text.split())
+
+
+def open_pdf(source):
+    if isinstance(source, (bytes, bytearray)):
+        return fitz.open(stream=source, filetype='pdf')
+    return fitz.open(source)
+
+
+def read_pages(doc, start, stop):
+    return [preprocess(doc.load_page(i).get_text("text")) for i in range(start, stop)]
+
+
+def extract_pages(source, start, stop):
+    with open_pdf(source) as doc:
+        return read_pages(doc, start, stop)